@@ -1,25 +1,40 @@
-from datetime import datetime
+import asyncio
+import gzip
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
 from http import HTTPStatus
-from typing import (Any, Dict, Iterable, List, NamedTuple, Optional, Tuple,
+from typing import (Any, Dict, FrozenSet, Iterable, List, Optional, Tuple,
                     Union)
 
-import iso8601
-from requests import ConnectionError as RequestsConnectionError
-from requests import Response, Session
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util import Retry
+import httpx
+import orjson
 
-Comment = NamedTuple('Comment', (('comment_id', str),
-                                 ('timestamp', datetime),
-                                 ('verbatim', str),
-                                 ('user_properties',
-                                  List[Union['NumberProperty',
-                                             'StringProperty']])))
 
-NumberProperty = NamedTuple('NumberProperty', (('name', str),
-                                               ('value', Union[float, int])))
+@dataclass(slots=True, frozen=True)
+class NumberProperty:
+    name: str
+    value: Union[float, int]
 
-StringProperty = NamedTuple('StringProperty', (('name', str), ('value', str)))
+
+@dataclass(slots=True, frozen=True)
+class StringProperty:
+    name: str
+    value: str
+
+
+@dataclass(slots=True, frozen=True)
+class Comment:
+    comment_id: str
+    timestamp: datetime
+    verbatim: str
+    user_properties: List[Union[NumberProperty, StringProperty]]
+
+
+# Defined ahead of the clients, which use it as a default argument.
+_RETRY_TOTAL = 5
 
 
 class ReinferSyncClient:
@@ -27,15 +42,39 @@ class ReinferSyncClient:
 
     On construction a `ReinferSyncClient` needs an `authentication_token`,
     which is then used to authenticate all requests peformed via the client.
+
+    Requests are made over HTTP/2 where the server supports it. Connection
+    errors and transient failures are retried up to `max_retries` times, with
+    jittered exponential backoff.
     """
 
-    def __init__(self, authentication_token: str, retry: Optional[Retry]=None):
+    def __init__(self,
+                 authentication_token: str,
+                 max_retries: int=_RETRY_TOTAL):
         """Builds a new `ReinferSyncClient` with an authentication token."""
-        self._session = Session()
-        self._session.headers['X-Auth-Token'] = authentication_token
-        self._session.headers['Content-Type'] = 'application/json'
-        self._session.mount('https://',
-                            HTTPAdapter(max_retries=retry or _DEFAULT_RETRY))
+        self._client = httpx.Client(
+            http2=True,
+            headers={
+                'X-Auth-Token': authentication_token,
+                'Content-Type': 'application/json',
+            },
+            limits=httpx.Limits(max_connections=_MAX_SYNC_CONNECTIONS,
+                                max_keepalive_connections=(
+                                    _MAX_SYNC_CONNECTIONS)),
+            timeout=_TIMEOUT_SECONDS,
+        )
+        self._max_retries = max_retries
+        self._batch_size = _AdaptiveBatchSize()
+
+    def close(self):
+        """Closes all pooled connections held by the client."""
+        self._client.close()
+
+    def __enter__(self) -> 'ReinferSyncClient':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def sync(self,
              dataset_name: str,
@@ -92,25 +131,30 @@ class ReinferSyncClient:
                 displayed on the website and enable filtering, segmentation and
                 statistics.
 
+        If a request is rate limited, the remaining comments are uploaded in
+        batches of half the size after a backoff. The batch size is doubled
+        again after a run of successful requests, up to the size which was
+        first rate limited.
+
         :raises NoSuchDatasetError: If the source doesn't exist
         :raises ValidationError: If any of the comments are malformed.
-        :raises RateLimitedError: If comments are being uploaded too fast.
+        :raises RateLimitedError: If comments are being uploaded too fast,
+            even after `max_retries` backoffs.
         :raises ReinferBackendError: In the case of transient server errors.
         """
-        try:
-            response = self._session.post(
-                'https://reinfer.io/api/voc/datasets/{}/sync'.format(
-                    dataset_name,
-                ),
-                json={
-                    'comments': [_comment_to_json(source_name, comment)
-                                 for comment in comments]
-                },
-            )
-        except RequestsConnectionError as error:
-            raise ConnectionError(error)
-
-        self._json(response)
+        comments = list(comments)
+        _validate_comments(comments)
+        batches = _SyncBatches(self._batch_size, comments, self._max_retries)
+        while not batches.done():
+            batch = batches.next_batch()
+            body, headers = _sync_request(source_name, batch)
+            response = self._post(_dataset_url(dataset_name, 'sync'),
+                                  body,
+                                  _SYNC_RETRY_STATUSES,
+                                  headers)
+            delay = batches.record(batch, response)
+            if delay is not None:
+                time.sleep(delay)
 
     def most_recent(self,
                     dataset_name: str,
@@ -124,52 +168,144 @@ class ReinferSyncClient:
         :raises EmptyDatasetError: If the source is empty.
         :raises ReinferBackendError: In case of transient server errors.
         """
-        try:
-            response = self._session.post(
-                'https://reinfer.io/api/voc/datasets/{}/recent'.format(
-                    dataset_name,
-                ),
-                json={
-                    'limit': 1,
-                    'filter': {
-                        'user_properties': {
-                            'string:Source': {'one_of': [source_name]},
-                        },
-                    },
-                },
-            )
-        except RequestsConnectionError as error:
-            raise ConnectionError(error)
-
-        results = self._json(response)['comments']
-        if len(results) == 0:
-            raise EmptyDatasetError(
-                'Dataset `{}` is empty.'.format(dataset_name))
-        comment_dict = results[0]
-        return (
-            comment_dict['id'],
-            iso8601.parse_date(comment_dict['timestamp']),
+        response = self._post(
+            _dataset_url(dataset_name, 'recent'),
+            orjson.dumps(_most_recent_request(source_name)),
+            _RETRY_STATUSES,
+        )
+        return _most_recent_from_json(dataset_name, _response_json(response))
+
+    def _post(self,
+              url: str,
+              body: bytes,
+              retry_statuses: FrozenSet[int],
+              headers: Optional[Dict[str, str]]=None) -> httpx.Response:
+        """POSTs `body` to `url`, retrying connection errors and responses
+        with any of the `retry_statuses`.
+
+        Once retries are exhausted, the last response is returned regardless
+        of its status.
+        """
+        num_retries = 0
+        while True:
+            response = None
+            try:
+                response = self._client.post(url,
+                                             content=body,
+                                             headers=headers)
+            except httpx.TransportError as error:
+                if num_retries == self._max_retries:
+                    raise ConnectionError(error)
+            else:
+                if (response.status_code not in retry_statuses or
+                        num_retries == self._max_retries):
+                    return response
+            time.sleep(_retry_delay(num_retries, response))
+            num_retries += 1
+
+
+class ReinferAsyncClient:
+    """An asyncio client for re:infer, with the same methods as
+    `ReinferSyncClient`.
+
+    Requests are made over HTTP/2 where the server supports it, so concurrent
+    requests share a single connection. Connection errors and transient
+    failures are retried up to `max_retries` times, as for
+    `ReinferSyncClient`.
+    """
+
+    def __init__(self,
+                 authentication_token: str,
+                 max_retries: int=_RETRY_TOTAL):
+        """Builds a new `ReinferAsyncClient` with an authentication token."""
+        self._client = httpx.AsyncClient(
+            http2=True,
+            headers={
+                'X-Auth-Token': authentication_token,
+                'Content-Type': 'application/json',
+            },
+            limits=httpx.Limits(max_connections=_MAX_ASYNC_CONNECTIONS,
+                                max_keepalive_connections=(
+                                    _MAX_ASYNC_CONNECTIONS)),
+            timeout=_TIMEOUT_SECONDS,
         )
+        self._max_retries = max_retries
+        self._batch_size = _AdaptiveBatchSize()
 
-    def _json(self, response: Response) -> Dict[str, Any]:
-        """Parses the JSON body and raises an exception based on status."""
-        try:
-            body = response.json()
-        except ValueError as error:
-            raise ReinferBackendError(error)
+    async def close(self):
+        """Closes all pooled connections held by the client."""
+        await self._client.aclose()
+
+    async def __aenter__(self) -> 'ReinferAsyncClient':
+        return self
 
-        if response.ok:
-            return body
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
-        message = body.get('message', '(no description available)')
-        if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
-            raise RateLimitedError(message)
-        elif response.status_code == HTTPStatus.BAD_REQUEST:
-            raise ValidationError(message)
-        elif response.status_code == HTTPStatus.NOT_FOUND:
-            raise NoSuchDatasetError(message)
-        else:
-            raise ReinferBackendError(message)
+    async def sync(self,
+                   dataset_name: str,
+                   source_name: str,
+                   comments: Iterable[Comment]):
+        """Synchronises a batch of comments.
+
+        See `ReinferSyncClient.sync` for details of the arguments and errors.
+        """
+        comments = list(comments)
+        _validate_comments(comments)
+        batches = _SyncBatches(self._batch_size, comments, self._max_retries)
+        while not batches.done():
+            batch = batches.next_batch()
+            body, headers = _sync_request(source_name, batch)
+            response = await self._post(_dataset_url(dataset_name, 'sync'),
+                                        body,
+                                        _SYNC_RETRY_STATUSES,
+                                        headers)
+            delay = batches.record(batch, response)
+            if delay is not None:
+                await asyncio.sleep(delay)
+
+    async def most_recent(self,
+                          dataset_name: str,
+                          source_name: str) -> Tuple[str, datetime]:
+        """Returns the id and timestamp of the most recent comment in a source.
+
+        See `ReinferSyncClient.most_recent` for details of the arguments and
+        errors.
+        """
+        response = await self._post(
+            _dataset_url(dataset_name, 'recent'),
+            orjson.dumps(_most_recent_request(source_name)),
+            _RETRY_STATUSES,
+        )
+        return _most_recent_from_json(dataset_name, _response_json(response))
+
+    async def _post(self,
+                    url: str,
+                    body: bytes,
+                    retry_statuses: FrozenSet[int],
+                    headers: Optional[Dict[str, str]]=None) -> httpx.Response:
+        """POSTs `body` to `url`, retrying connection errors and responses
+        with any of the `retry_statuses`.
+
+        Once retries are exhausted, the last response is returned regardless
+        of its status.
+        """
+        num_retries = 0
+        while True:
+            response = None
+            try:
+                response = await self._client.post(url,
+                                                   content=body,
+                                                   headers=headers)
+            except httpx.TransportError as error:
+                if num_retries == self._max_retries:
+                    raise ConnectionError(error)
+            else:
+                if (response.status_code not in retry_statuses or
+                        num_retries == self._max_retries):
+                    return response
+            await asyncio.sleep(_retry_delay(num_retries, response))
+            num_retries += 1
 
 
 class ReinferSyncError(Exception):
@@ -209,44 +345,285 @@ class ReinferBackendError(ReinferSyncError):
     """Raised in case of a transient backend error."""
 
 
-_DEFAULT_RETRY = Retry(
-    total=5,
-    backoff_factor=0.1,
-    raise_on_status=False,
-    method_whitelist=frozenset(['POST']),
-    status_forcelist=frozenset([
-        HTTPStatus.TOO_MANY_REQUESTS,
-        HTTPStatus.BAD_GATEWAY,
-        HTTPStatus.GATEWAY_TIMEOUT,
-        HTTPStatus.INTERNAL_SERVER_ERROR,
-        HTTPStatus.REQUEST_TIMEOUT,
-        HTTPStatus.SERVICE_UNAVAILABLE,
-    ])
-)
+_MAX_SYNC_CONNECTIONS = 16
+
+_MAX_ASYNC_CONNECTIONS = 32
+
+_TIMEOUT_SECONDS = 30
+
+# `sync` request bodies larger than this are gzip-ed. The keys repeated in
+# every comment compress well, and level 1 is much cheaper than the default.
+_GZIP_MIN_BYTES = 4096
+
+_BATCH_SIZE_GROWTH_SUCCESSES = 10
+
+_RETRY_BACKOFF_FACTOR = 1.0
+
+_RETRY_BACKOFF_MAX = 30
+
+_RETRY_STATUSES = frozenset([
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.GATEWAY_TIMEOUT,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.REQUEST_TIMEOUT,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+])
+
+# `sync` requests handle rate limiting themselves, by shrinking the batch.
+_SYNC_RETRY_STATUSES = _RETRY_STATUSES - {HTTPStatus.TOO_MANY_REQUESTS}
+
+# Statuses for which a `Retry-After` header is honoured, as in urllib3.
+_RETRY_AFTER_STATUSES = frozenset([
+    HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+])
+
+
+class _AdaptiveBatchSize:
+    """Tracks the largest batch of comments to upload in one `sync` request.
+
+    There is no limit until a request is rate limited, at which point the
+    limit becomes half the size of the rejected batch. It is doubled again
+    after each run of `_BATCH_SIZE_GROWTH_SUCCESSES` successful requests, and
+    removed once it reaches the size of the batch which was first rejected.
+
+    There is one per client, so successful requests from concurrent `sync`
+    calls all count towards the same run: with four concurrent calls, the
+    limit grows back about four times as fast as with one.
+    """
+
+    def __init__(self):
+        self._limit = None  # type: Optional[int]
+        self._first_rejected_size = None  # type: Optional[int]
+        self._num_successes = 0
+
+    def next_batch(self, comments: List[Comment]) -> List[Comment]:
+        """Returns the next batch to upload from the start of `comments`."""
+        if self._limit is None:
+            return comments
+        return comments[:self._limit]
+
+    def succeeded(self):
+        """Records that a batch was uploaded successfully."""
+        if self._limit is None:
+            return
+        self._num_successes += 1
+        if self._num_successes == _BATCH_SIZE_GROWTH_SUCCESSES:
+            self._limit *= 2
+            self._num_successes = 0
+            if self._limit >= self._first_rejected_size:
+                self._limit = None
+                self._first_rejected_size = None
+
+    def rate_limited(self, batch: List[Comment]):
+        """Records that `batch` was rate limited."""
+        if self._first_rejected_size is None:
+            self._first_rejected_size = len(batch)
+        self._limit = max(1, len(batch) // 2)
+        self._num_successes = 0
+
+
+class _SyncBatches:
+    """Splits the comments of a single `sync` call into batches, following
+    the client's `_AdaptiveBatchSize`.
+
+    The client uploads each batch, and passes the response to `record`, which
+    decides whether to move on or retry a smaller batch after a delay.
+    """
+
+    def __init__(self,
+                 batch_size: _AdaptiveBatchSize,
+                 comments: List[Comment],
+                 max_retries: int):
+        self._batch_size = batch_size
+        self._comments = comments
+        self._max_retries = max_retries
+        self._num_rate_limited = 0
+
+    def done(self) -> bool:
+        """Returns whether all comments have been uploaded."""
+        return not self._comments
+
+    def next_batch(self) -> List[Comment]:
+        """Returns the next batch of comments to upload."""
+        return self._batch_size.next_batch(self._comments)
+
+    def record(self,
+               batch: List[Comment],
+               response: httpx.Response) -> Optional[float]:
+        """Records the response to uploading `batch`.
+
+        Returns `None` if the batch was uploaded, or how long to wait before
+        retrying if it was rate limited.
+
+        :raises RateLimitedError: If rate limited more than `max_retries`
+            times in a row.
+        """
+        try:
+            _response_json(response)
+        except RateLimitedError:
+            if self._num_rate_limited == self._max_retries:
+                raise
+            self._batch_size.rate_limited(batch)
+            delay = _retry_delay(self._num_rate_limited, response)
+            self._num_rate_limited += 1
+            return delay
+        self._num_rate_limited = 0
+        self._batch_size.succeeded()
+        self._comments = self._comments[len(batch):]
+        return None
+
+
+def _retry_delay(num_retries: int,
+                 response: Optional[httpx.Response]) -> float:
+    """Returns how long to wait before retrying a request.
+
+    A `Retry-After` header on the response takes precedence. Otherwise the
+    backoff is exponential with full jitter, so that clients which were rate
+    limited at the same time do not all retry at the same time.
+    """
+    if (response is not None and
+            response.status_code in _RETRY_AFTER_STATUSES):
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return float(retry_after)
+    return random.uniform(0, min(_RETRY_BACKOFF_MAX,
+                                 _RETRY_BACKOFF_FACTOR * 2 ** num_retries))
+
+
+def _response_json(response: httpx.Response) -> Dict[str, Any]:
+    """Parses the JSON body and raises an exception based on status."""
+    try:
+        body = response.json()
+    except ValueError as error:
+        raise ReinferBackendError(error)
+
+    if response.status_code < HTTPStatus.BAD_REQUEST:
+        return body
+
+    message = body.get('message', '(no description available)')
+    if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+        raise RateLimitedError(message)
+    elif response.status_code == HTTPStatus.BAD_REQUEST:
+        raise ValidationError(message)
+    elif response.status_code == HTTPStatus.NOT_FOUND:
+        raise NoSuchDatasetError(message)
+    else:
+        raise ReinferBackendError(message)
+
+
+@lru_cache(maxsize=4)
+def _dataset_url(dataset_name: str, endpoint: str) -> str:
+    """Returns the URL of a dataset `endpoint`, e.g. 'sync' or 'recent'."""
+    return 'https://reinfer.io/api/voc/datasets/{}/{}'.format(dataset_name,
+                                                             endpoint)
+
+
+def _sync_request(
+    source_name: str,
+    comments: Iterable[Comment],
+) -> Tuple[bytes, Dict[str, str]]:
+    """Returns the body and extra headers for a `sync` request."""
+    body = _sync_body(source_name, comments)
+    headers = {}
+    if len(body) > _GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=1)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+
+def _sync_body(source_name: str, comments: Iterable[Comment]) -> bytes:
+    """Encodes the JSON request body for a `sync` request.
+
+    Each comment is serialised as soon as it is converted, so only the encoded
+    bytes for the batch are held in memory, rather than the intermediate
+    dictionaries for all comments as well.
+    """
+    dumps = orjson.dumps
+    comment_to_json = _comment_to_json
+    return b''.join((
+        b'{"comments":[',
+        b','.join(dumps(comment_to_json(source_name, comment))
+                  for comment in comments),
+        b']}',
+    ))
+
+
+def _most_recent_request(source_name: str) -> Dict[str, Any]:
+    """Returns the JSON body for a `recent` request for a single comment."""
+    return {
+        'limit': 1,
+        'filter': {
+            'user_properties': {
+                'string:Source': {'one_of': [source_name]},
+            },
+        },
+    }
+
+
+def _most_recent_from_json(dataset_name: str,
+                           body: Dict[str, Any]) -> Tuple[str, datetime]:
+    """Returns the id and timestamp from the body of a `recent` response."""
+    results = body['comments']
+    if len(results) == 0:
+        raise EmptyDatasetError(
+            'Dataset `{}` is empty.'.format(dataset_name))
+    comment_dict = results[0]
+    # On Python 3.10, `fromisoformat` doesn't accept a 'Z' suffix.
+    timestamp = datetime.fromisoformat(
+        comment_dict['timestamp'].replace('Z', '+00:00'),
+    )
+    if timestamp.tzinfo is None:
+        # Timestamps without an offset are UTC, as `iso8601` assumed.
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return comment_dict['id'], timestamp
 
 
 def _comment_to_json(source_name: str, comment: Comment) -> Dict[str, Any]:
-    user_properties = dict(map(_user_property_to_json,
+    user_properties = {'string:Source': source_name}
+    user_properties.update(map(_user_property_to_json,
                                comment.user_properties))
-    user_properties['string:Source'] = source_name
     return {
         'id': comment.comment_id,
-        'timestamp': comment.timestamp.isoformat(),
+        'timestamp': comment.timestamp,
         'original_text': comment.verbatim,
         'user_properties': user_properties,
     }
 
 
+def _validate_comments(comments: Iterable[Comment]):
+    """Checks the user properties of all `comments` before any are encoded.
+
+    :raises ValidationError: If any user property is of an unknown type or
+        uses a reserved name.
+    """
+    prefixes = _USER_PROPERTY_PREFIXES
+    reserved_names = _RESERVED_USER_PROPERTY_NAMES
+    for comment in comments:
+        for user_property in comment.user_properties:
+            if type(user_property) not in prefixes:
+                raise ValidationError(
+                    'Invalid user property {}'.format(user_property),
+                )
+            if user_property.name in reserved_names:
+                raise ValidationError(
+                    'Reserved user property name {}'.format(user_property),
+                )
+
+
 def _user_property_to_json(
     user_property: Union[StringProperty, NumberProperty],
 ) -> Tuple[str, Union[str, int, float]]:
-    if user_property.name in ('conversation', 'title', 'Source'):
-        raise ValidationError(
-            'Reserved user property name {}'.format(user_property),
-        )
+    """Converts a user property which has passed `_validate_comments`."""
+    return (_USER_PROPERTY_PREFIXES[type(user_property)] + user_property.name,
+            user_property.value)
+
+
+_USER_PROPERTY_PREFIXES = {
+    StringProperty: 'string:',
+    NumberProperty: 'number:',
+}
 
-    if isinstance(user_property, StringProperty):
-        return ('string:' + user_property.name, user_property.value)
-    if isinstance(user_property, NumberProperty):
-        return ('number:' + user_property.name, user_property.value)
-    raise ValidationError('Invalid user property {}'.fomat(user_property))
+_RESERVED_USER_PROPERTY_NAMES = frozenset(['conversation', 'title', 'Source'])
@@ -1,74 +1,204 @@
 #!/usr/bin/env python
+import asyncio
 import logging
+import os
 import sys
-import time
-from argparse import ArgumentParser
-from binascii import hexlify
+from argparse import ArgumentParser, Namespace
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, NamedTuple
+from functools import partial
+from operator import attrgetter
+from tempfile import NamedTemporaryFile
+from typing import List, Optional
 
 import pytz
 
 from client import (Comment, EmptyDatasetError, NumberProperty,
-                    ReinferSyncClient, StringProperty)
+                    ReinferAsyncClient, StringProperty)
+
+
+@dataclass(slots=True, frozen=True)
+class RawVerbatim:
+    raw_id: str
+    text: str
+    nps: int
+    timestamp: datetime
+    username: str
 
-RawVerbatim = NamedTuple('RawVerbatim', (('raw_id', str),
-                                         ('text', str),
-                                         ('nps', int),
-                                         ('timestamp', datetime),
-                                         ('username', str)))
 
 log = logging.getLogger(__name__)
 
+# Number of comments requested from the data source per page.
+_PAGE_SIZE = 40
+
+# Up to this many pages are fetched from the data source in each poll.
+_MAX_PAGES_PER_POLL = 12
+
+# The comments fetched in a poll are uploaded with concurrent `sync` requests
+# of up to this many comments each.
+_SYNC_BATCH_SIZE = 125
+
+# Number of threads used to fetch pages from the data source concurrently, and
+# to write checkpoints.
+_POLL_CONCURRENCY = 4
+
 
 class OnlineIntegration:
     """A sample polling, real-time data integration."""
 
     def __init__(self,
                  data_source: 'DataSource',
-                 client: ReinferSyncClient,
+                 client: ReinferAsyncClient,
                  dataset_name: str,
-                 source_name: str):
+                 source_name: str,
+                 checkpoint_path: Optional[str]=None):
+        """Builds a new `OnlineIntegration`.
+
+        If a `checkpoint_path` is given, the most recent timestamp sync-ed is
+        stored there after each poll, and read back on construction. This
+        saves asking re:infer for the most recent comment after a restart.
+        """
         self._client = client
         self._data_source = data_source
-        self._most_recent_timestamp = None
         self._dataset_name = dataset_name
         self._source_name = source_name
+        self._checkpoint_path = checkpoint_path
+        self._most_recent_timestamp = self._read_checkpoint()
         self._page_index = 0
+        self._executor = ThreadPoolExecutor(max_workers=_POLL_CONCURRENCY)
+
+    def close(self):
+        """Shuts down the threads used to read from the data source."""
+        self._executor.shutdown()
 
-    def poll(self):
+    async def poll(self):
         """Performs one poll, sync-ing any new comments from the source."""
         if self._most_recent_timestamp is None:
             try:
-                _, self._most_recent_timestamp = self._client.most_recent(
+                _, most_recent = await self._client.most_recent(
                     self._dataset_name,
                     self._source_name,
                 )
+                self._most_recent_timestamp = most_recent
             except EmptyDatasetError:
                 self._most_recent_timestamp = datetime(1970, 1, 1,
                                                        tzinfo=pytz.UTC)
 
         limit = self._timestamp_limit(self._most_recent_timestamp)
-        log.info('Sync-ing comments newer than %s, page %d...',
+        log.info('Sync-ing comments newer than %s, from page %d...',
                  limit,
                  self._page_index)
-        raw_verbatims = self._data_source.newer_than(
-            limit, page_index=self._page_index)
-        comments = list(map(_raw_to_comment, raw_verbatims))
+        # Only fan out to the following pages if the first one is full, so
+        # an idle source costs a single fetch per poll.
+        page_futures = [self._fetch_page(limit, self._page_index)]
+        comments = []  # type: List[Comment]
+        num_awaited = 0
+        num_full_pages = 0
+        try:
+            while num_awaited < len(page_futures):
+                raw_verbatims = await page_futures[num_awaited]
+                num_awaited += 1
+                comments.extend(map(_raw_to_comment, raw_verbatims))
+                if len(raw_verbatims) < _PAGE_SIZE:
+                    break
+                num_full_pages += 1
+                if num_awaited == 1:
+                    page_futures.extend(
+                        self._fetch_page(limit, self._page_index + i_page)
+                        for i_page in range(1, _MAX_PAGES_PER_POLL)
+                    )
+        finally:
+            for page_future in page_futures[num_awaited:]:
+                page_future.cancel()
         if not comments:
             log.info('No comments left to sync.')
             return
 
-        self._client.sync(self._dataset_name, self._source_name, comments)
+        sync_tasks = [
+            asyncio.ensure_future(self._client.sync(
+                self._dataset_name,
+                self._source_name,
+                comments[i_start:i_start + _SYNC_BATCH_SIZE],
+            ))
+            for i_start in range(0, len(comments), _SYNC_BATCH_SIZE)
+        ]
+        try:
+            await asyncio.gather(*sync_tasks)
+        finally:
+            # If one batch failed, stop the others rather than leaving them
+            # running (and possibly backing off) into the next poll.
+            for sync_task in sync_tasks:
+                sync_task.cancel()
+            await asyncio.gather(*sync_tasks, return_exceptions=True)
         if self._most_recent_timestamp != comments[-1].timestamp:
             self._most_recent_timestamp = comments[-1].timestamp
             self._page_index = 0
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_checkpoint)
         else:
-            self._page_index += 1
+            # Only skip past full pages: comments with later timestamps may
+            # still be added to the end of a short page.
+            self._page_index += num_full_pages
         log.info('Sync-d %d comments, most recent: %s',
                  len(comments),
                  self._most_recent_timestamp)
 
+    def _fetch_page(self,
+                    limit: datetime,
+                    page_index: int) -> 'asyncio.Future[List[RawVerbatim]]':
+        """Fetches a page from the data source on the executor."""
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            partial(self._data_source.newer_than,
+                    limit,
+                    page_size=_PAGE_SIZE,
+                    page_index=page_index),
+        )
+
+    def _read_checkpoint(self) -> Optional[datetime]:
+        """Returns the most recent timestamp stored in the checkpoint file, if
+        there is a valid one.
+        """
+        if self._checkpoint_path is None:
+            return None
+        try:
+            with open(self._checkpoint_path) as checkpoint_file:
+                timestamp = datetime.fromisoformat(
+                    checkpoint_file.read().strip())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning('Ignoring unreadable checkpoint %s.',
+                        self._checkpoint_path,
+                        exc_info=True)
+            return None
+        if timestamp.tzinfo is None:
+            log.warning('Ignoring checkpoint %s without a timezone.',
+                        self._checkpoint_path)
+            return None
+        log.info('Resuming from checkpoint, most recent: %s', timestamp)
+        return timestamp
+
+    def _write_checkpoint(self):
+        """Atomically stores the most recent timestamp in the checkpoint
+        file, if there is one.
+        """
+        if self._checkpoint_path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self._checkpoint_path))
+        temp_file = NamedTemporaryFile('w', dir=directory, delete=False)
+        try:
+            with temp_file:
+                temp_file.write(self._most_recent_timestamp.isoformat())
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_file.name, self._checkpoint_path)
+        except BaseException:
+            os.unlink(temp_file.name)
+            raise
+
     def _timestamp_limit(self, most_recent: datetime) -> datetime:
         """Given the most recent timestamp, returns the limit comments should
         retrieved from the data source.
@@ -83,7 +213,7 @@ class OnlineIntegration:
 def _raw_to_comment(raw: RawVerbatim) -> Comment:
     """Converts a `RawVerbatim` to a `Comment`."""
     return Comment(
-        comment_id=hexlify(raw.raw_id.encode('utf-8')).decode('utf-8'),
+        comment_id=raw.raw_id.encode('utf-8').hex(),
         timestamp=raw.timestamp,
         verbatim=raw.text,
         user_properties=[NumberProperty('NPS', raw.nps),
@@ -117,23 +247,19 @@ class FakeDataSource:
                         username='user{}'.format(i_comment))
             for i_comment in range(100)
         )
+        # Keep the verbatims sorted with a parallel list of their timestamps,
+        # so pages can be found with a binary search.
+        self._raw.sort(key=attrgetter('timestamp'))
+        self._timestamps = [raw.timestamp for raw in self._raw]
 
     def newer_than(self,
                    timestamp: datetime,
                    page_size: int=40,
                    page_index: int=0) -> List[RawVerbatim]:
         """Paginate through verbatims, in order of timestamp."""
-        num_skipped = page_index * page_size
-        page = []
-        for raw in self._raw:
-            if raw.timestamp >= timestamp:
-                if num_skipped > 0:
-                    num_skipped -= 1
-                else:
-                    page.append(raw)
-                    if len(page) == page_size:
-                        break
-        return page
+        start = (bisect_left(self._timestamps, timestamp) +
+                 page_index * page_size)
+        return self._raw[start:start + page_size]
 
 
 def main():
@@ -161,28 +287,53 @@ def main():
                         metavar='OWNER/NAME',
                         help='The dataset name to store the comments under, '
                         'prefixed with the owner eg. `company/chats`.')
+    parser.add_argument('--checkpoint-path',
+                        type=str,
+                        action='store',
+                        metavar='PATH',
+                        help='A file in which to store the timestamp of the '
+                        'most recent comment sync-ed, to resume from on '
+                        'restart.')
     arguments = parser.parse_args()
-    client = ReinferSyncClient(authentication_token=arguments.auth_token)
-    integration = OnlineIntegration(data_source=FakeDataSource(),
-                                    client=client,
-                                    dataset_name=arguments.dataset_name,
-                                    source_name=arguments.source_name)
-    consecutive_failures = 0
     try:
-        while True:
-            try:
-                integration.poll()
-                consecutive_failures = 0
-            except Exception:
-                log.exception('Exception in poll loop.')
-                consecutive_failures += 1
-                if consecutive_failures == 5:
-                    log.fatal('Too many consecutive failures, quitting.')
-                    sys.exit(1)
-            time.sleep(1.0)
+        asyncio.run(main_async(arguments))
     except KeyboardInterrupt:
         log.info('Ctrl-C pressed, done.')
 
 
+async def main_async(arguments: Namespace):
+    async with ReinferAsyncClient(
+            authentication_token=arguments.auth_token) as client:
+        integrations = [
+            OnlineIntegration(data_source=FakeDataSource(),
+                              client=client,
+                              dataset_name=arguments.dataset_name,
+                              source_name=arguments.source_name,
+                              checkpoint_path=arguments.checkpoint_path),
+        ]
+        try:
+            consecutive_failures = 0
+            while True:
+                results = await asyncio.gather(
+                    *[integration.poll() for integration in integrations],
+                    return_exceptions=True,
+                )
+                errors = [result for result in results
+                          if isinstance(result, Exception)]
+                for error in errors:
+                    log.error('Exception in poll loop.', exc_info=error)
+                if errors:
+                    consecutive_failures += 1
+                    if consecutive_failures == 5:
+                        log.fatal('Too many consecutive failures, quitting.')
+                        sys.exit(1)
+                else:
+                    consecutive_failures = 0
+                await asyncio.sleep(1.0)
+        finally:
+            for integration in integrations:
+                integration.close()
+
+
 if __name__ == '__main__':
     main()